@@ -1,7 +1,9 @@
 import requests
 from inputimeout import inputimeout, TimeoutOccurred
-import sys, sqlite3, re
-from datetime import datetime
+import sys, sqlite3, re, os, csv, gzip, mmap, struct, time, threading, tempfile
+from concurrent.futures import Future
+from itertools import islice
+from datetime import datetime, date
 from decimal import Decimal, ROUND_DOWN, ROUND_UP
 
 """
@@ -16,6 +18,20 @@ tuple (qty, subqty) guide:
 if __name__ == "__main__":
     # https://currencybeacon.com/signup
     API_KEY = ""
+    API_URL = "https://api.currencybeacon.com/v1/latest"
+    # seconds to wait for API before giving up, as concurrent callers all wait on the same call
+    API_TIMEOUT_SECONDS = 10
+
+    # API calls are budgeted to API_QUOTA_CALLS per API_QUOTA_SECONDS (free plan: 5000 per month),
+    # with bursts of up to API_QUOTA_BURST calls, after which the last good rates are used instead
+    # the budget is kept in the database, so it is shared by every process and kept across restarts
+    API_QUOTA_CALLS = 5000
+    API_QUOTA_SECONDS = 30 * 24 * 60 * 60
+    API_QUOTA_BURST = 20
+    # the publisher uses at most API_QUOTA_PUBLISH_SHARE of the refill and never takes the last API_QUOTA_RESERVE
+    # calls, so the rest of the budget is left for trade quotes, which need rates fresher than the publisher can give
+    API_QUOTA_PUBLISH_SHARE = 0.5
+    API_QUOTA_RESERVE = 10
 
     # https://currencybeacon.com/supported-currencies
     BASE_CURRENCY = "USD"
@@ -26,16 +42,61 @@ if __name__ == "__main__":
     BASE_START_QTY = 10000
     BASE_START_SUBQTY = 0
 
+    # checkpoints move old history rows into compressed, append-only segment files in this directory
+    ARCHIVE_DIR = "archive"
+
+    # exports stream history into new files in this directory, this many rows at a time
+    EXPORT_DIR = "export"
+    EXPORT_CHUNK_ROWS = 10000
+
+    # one publisher process (python fx.py publish) fetches rates every RATE_PUBLISH_SECONDS into this shared file
+    # all processes read rates from it while no older than RATE_MAX_AGE_SECONDS, otherwise they call the API directly
+    # the publisher calls the API at its share of the quota budget refill (free plan: every 1037 seconds),
+    # and published rates stay fresh for two publishes so one failed publish does not send every process to the API
+    RATE_SNAPSHOT_PATH = "rates.snapshot"
+    RATE_PUBLISH_SECONDS = max(10, API_QUOTA_SECONDS / (API_QUOTA_CALLS * API_QUOTA_PUBLISH_SHARE))
+    RATE_MAX_AGE_SECONDS = 2 * RATE_PUBLISH_SECONDS
+    # the age of rates older than this is shown wherever they are used
+    RATE_SHOW_AGE_SECONDS = 5
+
+    # trade quotes are only made from rates at most this old, so stale rates cannot be traded against
+    # published rates are usually older, so most quotes use the part of the budget the publisher leaves
+    QUOTE_MAX_AGE_SECONDS = 60
+
+    DB_PATH = "db"
+
+# rate snapshot file layout: header (seq, published time, number of records) then one record per fx currency
+# (currency, buy qty, buy subqty, sell qty, sell subqty); seq is odd while the publisher is mid-write
+RATE_HEADER = struct.Struct("<QdI")
+RATE_RECORD = struct.Struct("<4sqqqq")
+# memory map of the rate snapshot file, opened on first read
+rate_map = None
+
+# guards rate_future, which is shared between threads
+rate_lock = threading.Lock()
+# API fetch currently in flight, which concurrent callers wait on instead of making their own
+rate_future = None
+# last rates fetched from API, in the same form as read_rate_snapshot returns
+last_rates = None
+
+
+class RatesUnavailableError(Exception):
+    """Raised when rates cannot be fetched from API, due to an API error or the quota budget being used up"""
+
 
 def main():
     print("=== Currency Trader ===")
     # check if portfolio and history tables already exist, if not, create them
-    try:
-        cursor.execute("SELECT * FROM portfolio LIMIT 1")
-        cursor.execute("SELECT * FROM history LIMIT 1")
-        print("Welcome back\n")
-    except sqlite3.OperationalError:
+    # only missing tables lead to a reset, other database errors (E.g. locked by another process) are raised
+    cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name IN ('portfolio', 'history')")
+    if len(cursor.fetchall()) < 2:
         reset_portfolio()
+    else:
+        # databases created before checkpoints and exports existed lack their tables
+        create_maintenance_tables()
+        # history written before negative amounts under 1 kept their sign needs them restored
+        migrate_history_signs()
+        print("Welcome back\n")
 
     # main menu
     while True:
@@ -47,13 +108,15 @@ def main():
             "4. Sell FX",
             "5. History",
             "6. Reset",
-            "7. Exit",
+            "7. Checkpoint",
+            "8. Export",
+            "9. Exit",
             sep="\n"
         )
         # validate menu choice
         while True:
             menu = input("\tChoice: ").strip()
-            if menu in [str(x) for x in range(1, 8)]:
+            if menu in [str(x) for x in range(1, 10)]:
                 print()
                 break
 
@@ -81,6 +144,10 @@ def main():
                     print("Cancelled\n")
                     break
         elif menu == "7":
+            checkpoint_history()
+        elif menu == "8":
+            export_data()
+        elif menu == "9":
             db.close()
             print("Goodbye!")
             break
@@ -106,13 +173,43 @@ def create_tables():
     cursor.execute("INSERT INTO history (date, delta_base) VALUES (?,?)",
                    (datetime.now(), tuple2dp_to_str((BASE_START_QTY, BASE_START_SUBQTY))))
 
+    create_maintenance_tables()
+
+
+def create_maintenance_tables():
+    """Creates snapshot, rollup, archive and export tables if they do not already exist"""
+    # create new table: snapshot: portfolio holdings as of (and including) history row history_id
+    cursor.execute(
+        "CREATE TABLE IF NOT EXISTS snapshot (history_id INTEGER, date TEXT, currency TEXT, qty INTEGER, subqty INTEGER)")
+
+    # create new table: rollup: number of transactions and total deltas per month and currency of archived history
+    cursor.execute(
+        "CREATE TABLE IF NOT EXISTS rollup (period TEXT, currency TEXT, trades INTEGER, "
+        "fx_qty INTEGER, fx_subqty INTEGER, base_qty INTEGER, base_subqty INTEGER)")
+
+    # create new table: archive: one row per segment file holding history rows first_id to last_id
+    cursor.execute(
+        "CREATE TABLE IF NOT EXISTS archive (first_id INTEGER, last_id INTEGER, date TEXT, path TEXT)")
+
+    # create new table: export: one row per export file holding history rows first_id to last_id
+    cursor.execute(
+        "CREATE TABLE IF NOT EXISTS export (format TEXT, first_id INTEGER, last_id INTEGER, date TEXT, path TEXT)")
+
     db.commit()
 
 
 def drop_tables():
-    """Drops portfolio and history tables"""
-    cursor.execute("DROP TABLE IF EXISTS portfolio")
-    cursor.execute("DROP TABLE IF EXISTS history")
+    """Drops all tables and deletes archive segment files"""
+    # segment files are only reachable through the archive table, so delete them first
+    try:
+        cursor.execute("SELECT path FROM archive")
+        for (path,) in cursor.fetchall():
+            if os.path.exists(path):
+                os.remove(path)
+    except sqlite3.OperationalError:
+        pass
+    for table in ["portfolio", "history", "snapshot", "rollup", "archive", "export"]:
+        cursor.execute(f"DROP TABLE IF EXISTS {table}")
     db.commit()
 
 
@@ -156,46 +253,246 @@ def update_portfolio(currency: str, delta_fx: tuple[int, int], delta_base: tuple
     db.commit()
 
 
-def get_rates(fx_instruction) -> dict[str, tuple[int, int]]:
+def get_rates(fx_instruction, max_age: float = float("inf")) -> dict[str, tuple[int, int]]:
     """
-    Gets fx rates from API and returns as dict
+    Gets fx rates from the rate snapshot if fresh, otherwise from API, and returns as dict
+    If API is unavailable or over the quota budget, the last good rates no older than max_age are returned
+    and their age printed, RatesUnavailableError if there are none
     :param fx_instruction: Instruction for the fx currency as "buy" or "sell" only
+    :param max_age: Maximum age of rates in seconds (default any age), E.g. QUOTE_MAX_AGE_SECONDS for trade quotes
     :return: FX rates in fx per base as dict {key = currency, value = (qty, subqty)} where 1 qty = 10000 subqty
     """
     # fx_instruction must be "buy" or "sell", we get the worse 4dp rounded rate based on the instruction
     if fx_instruction not in ["buy", "sell"]:
         raise ValueError("get_rates takes argument 'buy' or 'sell' only")
 
+    # rates published by another process are used while fresh, saving an API call
+    snapshot = read_rate_snapshot()
+    fallback_reason = None
+    if snapshot is None or time.time() - snapshot[0] > min(RATE_MAX_AGE_SECONDS, max_age):
+        try:
+            snapshot = fetch_rate_snapshot()
+        except RatesUnavailableError as e:
+            # degrade to the newest good rates available, published or fetched, unless too old
+            fallbacks = [x for x in [snapshot, last_rates] if x is not None and time.time() - x[0] <= max_age]
+            if not fallbacks:
+                raise
+            snapshot = max(fallbacks, key=lambda x: x[0])
+            fallback_reason = e
+
+    # the age is always shown for fallback rates, and for any other rates which are not from just now
+    age = time.time() - snapshot[0]
+    if fallback_reason is not None:
+        print(f"{fallback_reason}: using rates from {age:.0f} seconds ago")
+    elif age > RATE_SHOW_AGE_SECONDS:
+        print(f"Using rates from {age:.0f} seconds ago")
+
+    return {currency: rates[0 if fx_instruction == "buy" else 1] for currency, rates in snapshot[1].items()}
+
+
+def fetch_rate_snapshot() -> tuple[float, dict[str, tuple[tuple[int, int], tuple[int, int]]]]:
+    """
+    Gets fx rates from API within the quota budget, sharing one API call between concurrent callers
+    :return: (fetched time, rates) where rates is dict {key = currency, value = (buy rate, sell rate)}
+        with rates as (qty, subqty) where 1 qty = 10000 subqty
+    """
+    global rate_future, last_rates
+    # the first caller makes the API call, callers arriving while it is in flight wait for its result
+    with rate_lock:
+        future = rate_future
+        leader = future is None
+        if leader:
+            future = rate_future = Future()
+    if not leader:
+        return future.result()
+
+    try:
+        if not take_quota_token():
+            raise RatesUnavailableError("API quota budget used up")
+        rates = fetch_rates()
+        last_rates = (time.time(), {currency: (round_rate(rate, "buy"), round_rate(rate, "sell"))
+                                    for currency, rate in rates.items()})
+        future.set_result(last_rates)
+    except BaseException as e:
+        future.set_exception(e)
+    finally:
+        with rate_lock:
+            rate_future = None
+    return future.result()
+
+
+def take_quota_token(reserve: int = 0) -> bool:
+    """
+    Takes one API call from the quota budget token bucket, which refills at API_QUOTA_CALLS per API_QUOTA_SECONDS
+    :param reserve: Number of calls which must be left in the budget after this one
+    :return: True if an API call may be made, False if the budget is used up
+    """
+    # the bucket is one row in the database, locked for writing so concurrent processes and threads take turns
+    # each call uses its own connection, as it may run on any thread and in the publisher which has no database open
+    quota_db = sqlite3.connect(DB_PATH, timeout=30, isolation_level=None)
+    try:
+        quota_db.execute("CREATE TABLE IF NOT EXISTS quota (tokens REAL, time REAL)")
+        quota_db.execute("BEGIN IMMEDIATE")
+        bucket = quota_db.execute("SELECT tokens, time FROM quota").fetchone()
+        now = time.time()
+        if bucket is None:
+            tokens = API_QUOTA_BURST
+        else:
+            tokens = min(API_QUOTA_BURST, bucket[0] + max(0, now - bucket[1]) * API_QUOTA_CALLS / API_QUOTA_SECONDS)
+        taken = tokens >= 1 + reserve
+        if taken:
+            tokens -= 1
+        quota_db.execute("DELETE FROM quota")
+        quota_db.execute("INSERT INTO quota VALUES (?,?)", (tokens, now))
+        quota_db.execute("COMMIT")
+        return taken
+    finally:
+        quota_db.close()
+
+
+def fetch_rates() -> dict[str, float | int]:
+    """
+    Gets unrounded fx rates from API and returns as dict, RatesUnavailableError on API error
+    :return: FX rates in fx per base as dict {key = currency, value = rate}
+    """
     # API url to return JSON format
-    url = "https://api.currencybeacon.com/v1/latest?api_key=" + API_KEY \
-          + "&base=" + BASE_CURRENCY + "&symbols=" + ",".join(FX_CURRENCIES)
+    url = API_URL + "?api_key=" + API_KEY + "&base=" + BASE_CURRENCY + "&symbols=" + ",".join(FX_CURRENCIES)
 
     # API call and error handling
     try:
-        data = requests.get(url).json()
+        data = requests.get(url, timeout=API_TIMEOUT_SECONDS).json()
     except Exception:
-        sys.exit("API timeout")
-    if data["meta"]["code"] != 200:
-        sys.exit(f"API error code {data['meta']['code']}")
-
-    # creation of dictionary and rate data error handling
+        raise RatesUnavailableError("API timeout")
+    # a response of the wrong shape is treated as an API error
+    try:
+        code = data["meta"]["code"]
+        api_rates = data["response"]["rates"] if code == 200 else None
+    except (KeyError, IndexError, TypeError):
+        raise RatesUnavailableError("API returned malformed response")
+    if code != 200:
+        raise RatesUnavailableError(f"API error code {code}")
+    if not isinstance(api_rates, dict):
+        raise RatesUnavailableError("API returned malformed response")
+    missing = [currency for currency in FX_CURRENCIES if currency not in api_rates]
+    if missing:
+        raise RatesUnavailableError(f"API returned no rate for {', '.join(missing)}")
+
+    # creation of dictionary and rate data error handling, for every fx currency
     rates = {}
-    for currency in data["response"]["rates"]:
-        rate = data["response"]["rates"][currency]
-        if not isinstance(rate, (float, int)):
-            sys.exit(f"API returned non-numeric rate. 1 {BASE_CURRENCY} = {currency} {rate}")
-        if data["response"]["rates"][currency] <= 0:
-            sys.exit(f"API returned non-positive rate. 1 {BASE_CURRENCY} = {currency} {rate}")
-
-        # return the worse 4dp rounded rate based on the instruction
-        if fx_instruction == "buy":
-            rates[currency] = (int(rate), int(str(Decimal(rate).quantize(Decimal("0.0001"), rounding=ROUND_DOWN))[-4:]))
-        else:
-            rates[currency] = (int(rate), int(str(Decimal(rate).quantize(Decimal("0.0001"), rounding=ROUND_UP))[-4:]))
+    for currency in FX_CURRENCIES:
+        rate = api_rates[currency]
+        if not isinstance(rate, (float, int)) or isinstance(rate, bool):
+            raise RatesUnavailableError(f"API returned non-numeric rate. 1 {BASE_CURRENCY} = {currency} {rate}")
+        if rate <= 0:
+            raise RatesUnavailableError(f"API returned non-positive rate. 1 {BASE_CURRENCY} = {currency} {rate}")
+        rates[currency] = rate
 
     return rates
 
 
+def round_rate(rate: float | int, fx_instruction: str) -> tuple[int, int]:
+    """
+    Returns the worse 4dp rounded rate based on the instruction
+    :param rate: FX rate in fx per base as float or int
+    :param fx_instruction: Instruction for the fx currency as "buy" (round down) or "sell" (round up) only
+    :return: FX rate as (qty, subqty) where 1 qty = 10000 subqty
+    """
+    if fx_instruction == "buy":
+        return (int(rate), int(str(Decimal(rate).quantize(Decimal("0.0001"), rounding=ROUND_DOWN))[-4:]))
+    return (int(rate), int(str(Decimal(rate).quantize(Decimal("0.0001"), rounding=ROUND_UP))[-4:]))
+
+
+def write_rate_snapshot(snapshot: mmap.mmap, rates: dict[str, float | int]):
+    """
+    Writes rounded buy and sell rates into the memory mapped rate snapshot
+    :param snapshot: Memory map of the rate snapshot file, sized for all FX_CURRENCIES
+    :param rates: Unrounded FX rates in fx per base as dict {key = currency, value = rate}
+    """
+    # every record is built before anything is written, so a bad rate leaves the previous snapshot intact
+    missing = [currency for currency in FX_CURRENCIES if currency not in rates]
+    if missing:
+        raise RatesUnavailableError(f"no rate for {', '.join(missing)}")
+    records = [(currency.encode(), *round_rate(rates[currency], "buy"), *round_rate(rates[currency], "sell"))
+               for currency in FX_CURRENCIES]
+
+    # seqlock: seq is odd while writing, so readers retry rather than read a half-written snapshot
+    # seq is rounded up to even first, as a publisher stopped mid-write leaves it odd
+    seq = RATE_HEADER.unpack_from(snapshot, 0)[0]
+    seq += seq % 2
+    RATE_HEADER.pack_into(snapshot, 0, seq + 1, time.time(), len(FX_CURRENCIES))
+    for i, record in enumerate(records):
+        RATE_RECORD.pack_into(snapshot, RATE_HEADER.size + i * RATE_RECORD.size, *record)
+    RATE_HEADER.pack_into(snapshot, 0, seq + 2, time.time(), len(FX_CURRENCIES))
+
+
+def read_rate_snapshot() -> tuple[float, dict[str, tuple[tuple[int, int], tuple[int, int]]]] | None:
+    """
+    Reads a consistent copy of the rate snapshot published by another process
+    :return: (published time, rates) where rates is dict {key = currency, value = (buy rate, sell rate)}
+        with rates as (qty, subqty) where 1 qty = 10000 subqty, or None if no complete snapshot is available
+    """
+    global rate_map
+    size = RATE_HEADER.size + RATE_RECORD.size * len(FX_CURRENCIES)
+    if rate_map is None:
+        try:
+            with open(RATE_SNAPSHOT_PATH, "rb") as file:
+                rate_map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            # no publisher has created the file yet (an empty file cannot be mapped either)
+            return None
+    if len(rate_map) < size:
+        rate_map.close()
+        rate_map = None
+        return None
+
+    # seqlock: retry while the publisher is mid-write or has written since we started reading
+    for _ in range(100):
+        seq, published, count = RATE_HEADER.unpack_from(rate_map, 0)
+        if seq == 0 or seq % 2 == 1 or count != len(FX_CURRENCIES):
+            continue
+        rates = {}
+        for i in range(count):
+            currency, buy_qty, buy_subqty, sell_qty, sell_subqty = \
+                RATE_RECORD.unpack_from(rate_map, RATE_HEADER.size + i * RATE_RECORD.size)
+            rates[currency.rstrip(b"\0").decode()] = ((buy_qty, buy_subqty), (sell_qty, sell_subqty))
+        if RATE_HEADER.unpack_from(rate_map, 0)[0] == seq:
+            # a publisher configured with other currencies is ignored
+            if list(rates) != FX_CURRENCIES:
+                return None
+            return (published, rates)
+    return None
+
+
+def publish_rates():
+    """Fetches fx rates from API every RATE_PUBLISH_SECONDS and publishes them to the rate snapshot file"""
+    size = RATE_HEADER.size + RATE_RECORD.size * len(FX_CURRENCIES)
+    # the file is resized in place rather than replaced, so readers already mapping it keep seeing updates
+    with open(RATE_SNAPSHOT_PATH, "a+b") as file:
+        file.truncate(size)
+        with mmap.mmap(file.fileno(), size) as snapshot:
+            print(f"Publishing rates to {RATE_SNAPSHOT_PATH} every {RATE_PUBLISH_SECONDS:.0f} seconds")
+            while True:
+                publish_rates_once(snapshot)
+                time.sleep(RATE_PUBLISH_SECONDS)
+
+
+def publish_rates_once(snapshot: mmap.mmap) -> bool:
+    """
+    Fetches fx rates from API within the publisher's part of the quota budget and publishes them
+    :param snapshot: Memory map of the rate snapshot file, sized for all FX_CURRENCIES
+    :return: True if rates were published, False otherwise
+    """
+    # on API error or used up quota budget, readers keep the previous rates until they go stale
+    try:
+        if not take_quota_token(reserve=API_QUOTA_RESERVE):
+            raise RatesUnavailableError("API quota budget used up")
+        write_rate_snapshot(snapshot, fetch_rates())
+        return True
+    except RatesUnavailableError as e:
+        print(e)
+        return False
+
+
 def portfolio_value() -> float:
     """
     Gets portfolio and returns its value in base currency as if all fx holdings were to be sold at current fx rates
@@ -352,11 +649,33 @@ def tuple2dp_to_str(quantity: tuple[int, int], decimal_places: int = 2) -> str:
 
     # in string form, pad subqty to decimal_places
     if quantity[1] < 0:
-        # in string form, remove negative sign from subqty only
-        return f"{quantity[0]}.{-quantity[1]:{'0'}{decimal_places}}"
+        # in string form, remove negative sign from subqty only (qty of 0 has no sign, so add it back)
+        return f"{'-' if quantity[0] == 0 else ''}{quantity[0]}.{-quantity[1]:{'0'}{decimal_places}}"
     return f"{quantity[0]}.{quantity[1]:{'0'}{decimal_places}}"
 
 
+def str_to_subqty(s: str | None) -> int:
+    """Returns signed total subqty given a history delta string, 0 for None
+    :param s: Signed decimal string with max precision to 2 decimal places as stored in history E.g. "-12.05"
+    :return: Quantity as a single int where 1 qty = 100 subqty E.g. -1205
+    """
+    if s is None:
+        return 0
+    sign = -1 if s.startswith("-") else 1
+    qty, subqty = str_to_tuple2dp(s.removeprefix("-"))
+    return sign * (qty * 100 + subqty)
+
+
+def subqty_to_tuple2dp(subqty: int) -> tuple[int, int]:
+    """Returns (qty, subqty) given signed total subqty
+    :param subqty: Quantity as a single int where 1 qty = 100 subqty E.g. -1205
+    :return: Quantity as (qty, subqty) with both items of the same sign E.g. (-12,-5)
+    """
+    if subqty < 0:
+        return (-(-subqty // 100), -(-subqty % 100))
+    return (subqty // 100, subqty % 100)
+
+
 def tuple2dp_greaterthan(a: tuple[int, int], b: tuple[int, int]) -> bool:
     """
     Returns whether a > b
@@ -408,6 +727,260 @@ def tuple2dp_add(a: tuple[int, int], b: tuple[int, int]) -> tuple[int, int]:
     return (c_qty, c_subqty)
 
 
+def iter_history(after_id: int = 0):
+    """
+    Yields history rows in id order, spanning archive segments then the live history table
+    :param after_id: Only yield rows with id greater than this
+    :return: Generator of rows as (id, date, currency, delta_fx, delta_base) with None for missing values
+    """
+    # the archive list and live rows are read in one read transaction, so a checkpoint by another process
+    # part way through cannot move rows out of the live table after the archive list was read
+    began = not db.in_transaction
+    if began:
+        db.execute("BEGIN")
+    try:
+        # segments are read lazily one row at a time; separate cursors leave the shared cursor free for callers
+        segments = db.execute("SELECT path FROM archive WHERE last_id > ? ORDER BY first_id", (after_id,)).fetchall()
+        live = db.execute(
+            "SELECT id, date, currency, delta_fx, delta_base FROM history WHERE id > ? ORDER BY id", (after_id,))
+        for (path,) in segments:
+            with gzip.open(path, "rt", newline="") as file:
+                for row in csv.reader(file):
+                    if int(row[0]) > after_id:
+                        yield (int(row[0]), row[1], *[None if x == "" else x for x in row[2:]])
+        yield from live
+    finally:
+        if began:
+            db.commit()
+
+
+def apply_history_row(balances: dict[str, int], row: tuple) -> None:
+    """
+    Adds the deltas of one history row to balances in place
+    :param balances: Holdings as dict {key = currency, value = signed total subqty} where 1 qty = 100 subqty
+    :param row: History row as (id, date, currency, delta_fx, delta_base)
+    """
+    currency, delta_fx, delta_base = row[2:]
+    # the starting entry has no fx currency, only a base delta
+    if currency is not None:
+        balances[currency] = balances.get(currency, 0) + str_to_subqty(delta_fx)
+    balances[BASE_CURRENCY] = balances.get(BASE_CURRENCY, 0) + str_to_subqty(delta_base)
+
+
+def get_snapshot() -> tuple[int, dict[str, int]]:
+    """
+    Gets the latest portfolio snapshot from database
+    :return: (history_id, balances) where balances is dict {key = currency, value = signed total subqty},
+        or (0, {}) if no checkpoint has been made
+    """
+    cursor.execute("SELECT MAX(history_id) FROM snapshot")
+    history_id = cursor.fetchone()[0]
+    if history_id is None:
+        return (0, {})
+    cursor.execute("SELECT currency, qty, subqty FROM snapshot WHERE history_id = ?", (history_id,))
+    return (history_id, {row[0]: row[1] * 100 + row[2] for row in cursor.fetchall()})
+
+
+def checkpoint(cutoff: str) -> int:
+    """
+    Moves history rows dated before cutoff into a new compressed archive segment,
+    adding their monthly rollups and a portfolio snapshot as of the last row archived
+    :param cutoff: Date as "YYYY-MM-DD", rows dated strictly before it are archived
+    :return: Number of history rows archived, ValueError without changes if history does not reproduce the portfolio,
+        sqlite3.Error without changes if the database cannot be written
+    """
+    # hold the write lock throughout, so no other process changes history or portfolio mid-checkpoint,
+    # and any failure rolls back every write and removes the segment file
+    cursor.execute("BEGIN IMMEDIATE")
+    path = None
+    try:
+        # archive everything up to the last row before cutoff so the archived ids are always a contiguous prefix
+        cursor.execute("SELECT MAX(id) FROM history WHERE date < ?", (cutoff,))
+        last_id = cursor.fetchone()[0]
+        if last_id is None:
+            db.rollback()
+            return 0
+        cursor.execute("SELECT MIN(id) FROM history")
+        first_id = cursor.fetchone()[0]
+
+        # snapshot starts from the previous snapshot, with every currency present even if never traded
+        balances = {currency: 0 for currency in [BASE_CURRENCY] + FX_CURRENCIES}
+        balances.update(get_snapshot()[1])
+        # rollups as dict {key = (period, currency), value = [trades, delta_fx, delta_base]} in subqty
+        rollups = {}
+
+        # stream rows into the segment file, written under a temporary name so a partial file is never recorded
+        # snapshot is checked against the portfolio before anything is deleted, so a bad checkpoint is never made
+        os.makedirs(ARCHIVE_DIR, exist_ok=True)
+        path = os.path.join(ARCHIVE_DIR, f"history_{first_id}_{last_id}.csv.gz")
+        rows = 0
+        with gzip.open(path + ".tmp", "wt", newline="") as file:
+            writer = csv.writer(file)
+            for row in db.execute("SELECT id, date, currency, delta_fx, delta_base FROM history WHERE id <= ? "
+                                  "ORDER BY id", (last_id,)):
+                writer.writerow(["" if x is None else x for x in row])
+                apply_history_row(balances, row)
+                rollup = rollups.setdefault((row[1][:7], row[2] or BASE_CURRENCY), [0, 0, 0])
+                rollup[0] += 1
+                rollup[1] += str_to_subqty(row[3])
+                rollup[2] += str_to_subqty(row[4])
+                rows += 1
+        if not history_matches_portfolio(balances, last_id):
+            raise ValueError("snapshot and history do not match portfolio")
+        os.replace(path + ".tmp", path)
+
+        # record segment, snapshot and rollups and delete archived rows
+        now = datetime.now()
+        cursor.execute("INSERT INTO archive VALUES (?,?,?,?)", (first_id, last_id, now, path))
+        cursor.executemany("INSERT INTO snapshot VALUES (?,?,?,?,?)",
+                           [(last_id, now, currency, *subqty_to_tuple2dp(balances[currency])) for currency in balances])
+        for (period, currency), (trades, delta_fx, delta_base) in rollups.items():
+            cursor.execute("SELECT trades, fx_qty, fx_subqty, base_qty, base_subqty FROM rollup "
+                           "WHERE period = ? AND currency = ?", (period, currency))
+            old = cursor.fetchone()
+            if old is None:
+                cursor.execute("INSERT INTO rollup VALUES (?,?,?,?,?,?,?)",
+                               (period, currency, trades,
+                                *subqty_to_tuple2dp(delta_fx), *subqty_to_tuple2dp(delta_base)))
+            else:
+                cursor.execute("UPDATE rollup SET trades = ?, fx_qty = ?, fx_subqty = ?, base_qty = ?, base_subqty = ? "
+                               "WHERE period = ? AND currency = ?",
+                               (old[0] + trades, *tuple2dp_add((old[1], old[2]), subqty_to_tuple2dp(delta_fx)),
+                                *tuple2dp_add((old[3], old[4]), subqty_to_tuple2dp(delta_base)), period, currency))
+        cursor.execute("DELETE FROM history WHERE id <= ?", (last_id,))
+        db.commit()
+    except BaseException:
+        db.rollback()
+        if path is not None:
+            for leftover in [path + ".tmp", path]:
+                if os.path.exists(leftover):
+                    os.remove(leftover)
+        raise
+    return rows
+
+
+def compact_database():
+    """Returns pages freed by checkpoints to the filesystem so the live database stays small"""
+    cursor.execute("VACUUM")
+
+
+def verify_checkpoint() -> bool:
+    """
+    Checks that the latest snapshot plus all remaining live history reproduces current portfolio holdings exactly
+    :return: True if every currency matches, False otherwise
+    """
+    history_id, balances = get_snapshot()
+    return history_matches_portfolio(balances, history_id)
+
+
+def history_matches_portfolio(balances: dict[str, int], history_id: int) -> bool:
+    """
+    Checks that balances as of history row history_id plus all later live history reproduces current portfolio holdings
+    :param balances: Holdings as dict {key = currency, value = signed total subqty} where 1 qty = 100 subqty
+    :param history_id: Id of the last history row included in balances
+    :return: True if every currency matches, False otherwise
+    """
+    balances = dict(balances)
+    for row in db.execute("SELECT id, date, currency, delta_fx, delta_base FROM history WHERE id > ? ORDER BY id",
+                          (history_id,)):
+        apply_history_row(balances, row)
+    portfolio = get_portfolio()
+    return all(balances.get(currency, 0) == qty * 100 + subqty for currency, (qty, subqty) in portfolio.items())
+
+
+def migrate_history_signs() -> int:
+    """
+    Restores the negative sign of history deltas under 1 written as E.g. "0.50" instead of "-0.50" by older versions
+    Rows where both deltas are under 1 are left as they are, as either could be the negative one
+    :return: Number of history rows fixed
+    """
+    fixed = []
+    for row_id, delta_fx, delta_base in db.execute(
+            "SELECT id, delta_fx, delta_base FROM history WHERE currency IS NOT NULL "
+            "AND delta_fx NOT LIKE '-%' AND delta_base NOT LIKE '-%'"):
+        # every trade spends one side, so one nonzero delta without a sign must be negative
+        unsigned = [delta for delta in [delta_fx, delta_base] if delta.startswith("0.") and str_to_subqty(delta) != 0]
+        if len(unsigned) != 1:
+            continue
+        if unsigned[0] == delta_fx:
+            fixed.append(("-" + delta_fx, delta_base, row_id))
+        else:
+            fixed.append((delta_fx, "-" + delta_base, row_id))
+    cursor.executemany("UPDATE history SET delta_fx = ?, delta_base = ? WHERE id = ?", fixed)
+    db.commit()
+    return len(fixed)
+
+
+def export_history(export_format: str, chunk_rows: int | None = None) -> tuple[str | None, int]:
+    """
+    Streams history rows not yet exported in export_format into a new file, chunk_rows rows at a time
+    :param export_format: "csv" or "parquet" only (parquet requires pyarrow)
+    :param chunk_rows: Number of rows held in memory at once (default EXPORT_CHUNK_ROWS)
+    :return: (path, rows) of the new file, or (None, 0) if there were no new rows
+    """
+    if export_format not in ["csv", "parquet"]:
+        raise ValueError("export_history takes argument 'csv' or 'parquet' only")
+    if chunk_rows is None:
+        chunk_rows = EXPORT_CHUNK_ROWS
+    if export_format == "parquet":
+        # optional dependency only needed for parquet
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        schema = pa.schema([("id", pa.int64()), ("date", pa.string()), ("currency", pa.string()),
+                            ("delta_fx_subqty", pa.int64()), ("delta_base_subqty", pa.int64())])
+
+    # incremental: continue from the last id exported in this format
+    cursor.execute("SELECT MAX(last_id) FROM export WHERE format = ?", (export_format,))
+    after_id = cursor.fetchone()[0] or 0
+    history = iter_history(after_id)
+    chunk = list(islice(history, chunk_rows))
+    if not chunk:
+        return (None, 0)
+
+    # deltas are exported as signed total subqty ints (1 qty = 100 subqty) rather than decimal strings
+    # file is written under a unique temporary name and renamed once complete so a partial file is never recorded
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(suffix=".tmp", dir=EXPORT_DIR)
+    os.close(fd)
+    first_id = chunk[0][0]
+    rows = 0
+    if export_format == "csv":
+        with open(tmp, "w", newline="") as file:
+            writer = csv.writer(file)
+            writer.writerow(["id", "date", "currency", "delta_fx_subqty", "delta_base_subqty"])
+            while chunk:
+                writer.writerows([(row[0], row[1], row[2], None if row[3] is None else str_to_subqty(row[3]),
+                                   str_to_subqty(row[4])) for row in chunk])
+                rows += len(chunk)
+                last_id = chunk[-1][0]
+                chunk = list(islice(history, chunk_rows))
+    else:
+        with pq.ParquetWriter(tmp, schema) as writer:
+            # each chunk becomes one row group
+            while chunk:
+                writer.write_table(pa.table({
+                    "id": [row[0] for row in chunk],
+                    "date": [str(row[1]) for row in chunk],
+                    "currency": [row[2] for row in chunk],
+                    "delta_fx_subqty": [None if row[3] is None else str_to_subqty(row[3]) for row in chunk],
+                    "delta_base_subqty": [str_to_subqty(row[4]) for row in chunk],
+                }, schema=schema))
+                rows += len(chunk)
+                last_id = chunk[-1][0]
+                chunk = list(islice(history, chunk_rows))
+    # ids restart after a reset, so the export time keeps paths unique and earlier exports are never overwritten
+    now = datetime.now()
+    path = os.path.join(EXPORT_DIR, f"history_{first_id}_{last_id}_{now:%Y%m%d%H%M%S%f}.{export_format}")
+    if os.path.exists(path):
+        os.remove(tmp)
+        raise FileExistsError(f"export file already exists: {path}")
+    os.replace(tmp, path)
+
+    cursor.execute("INSERT INTO export VALUES (?,?,?,?,?)", (export_format, first_id, last_id, now, path))
+    db.commit()
+    return (path, rows)
+
+
 # ===Main Menu Options===
 
 def print_portfolio():
@@ -416,15 +989,23 @@ def print_portfolio():
     print("=== Portfolio ===")
     for currency in portfolio:
         print(f"{currency}: {tuple2dp_to_str(portfolio[currency])}")
-    value = portfolio_value()
+    try:
+        value = portfolio_value()
+    except RatesUnavailableError as e:
+        print(f"Value unavailable: {e}\n")
+        return
     print(f"Value: {base_text(value)}")
     print(f"Return: {portfolio_return(value)}\n")
 
 
 def print_rates():
     """Print fx rates in fx per base for all fx currencies"""
-    rates = get_rates("buy")
     print("=== FX Rates ===")
+    try:
+        rates = get_rates("buy")
+    except RatesUnavailableError as e:
+        print(f"Rates unavailable: {e}\n")
+        return
     for currency in rates:
         print(f"1 {BASE_CURRENCY} = {currency} {tuple2dp_to_str(rates[currency], decimal_places=4)}")
     print()
@@ -458,8 +1039,12 @@ def buy_fx():
         print("\tInsufficient funds\n")
         return
 
-    # get fx received for base spent and ask user to confirm within 10 seconds
-    fx_bought = fx_received(get_rates("buy")[fx_selected], base_spent)
+    # get fx received for base spent from recent rates only and ask user to confirm within 10 seconds
+    try:
+        fx_bought = fx_received(get_rates("buy", max_age=QUOTE_MAX_AGE_SECONDS)[fx_selected], base_spent)
+    except RatesUnavailableError as e:
+        print(f"\tRates unavailable: {e}\n")
+        return
     print("Quote expires in 10 seconds")
     print(f"\tBuy {fx_selected} {tuple2dp_to_str(fx_bought)} for {BASE_CURRENCY} {tuple2dp_to_str(base_spent)}")
     try:
@@ -504,8 +1089,12 @@ def sell_fx():
         print("\tInsufficient funds\n")
         return
 
-    # get base received for fx spent and ask user to confirm within 10 seconds
-    base_bought = base_received(get_rates("sell")[fx_selected], fx_spent)
+    # get base received for fx spent from recent rates only and ask user to confirm within 10 seconds
+    try:
+        base_bought = base_received(get_rates("sell", max_age=QUOTE_MAX_AGE_SECONDS)[fx_selected], fx_spent)
+    except RatesUnavailableError as e:
+        print(f"\tRates unavailable: {e}\n")
+        return
     print("Quote expires in 10 seconds")
     print(f"\tBuy {BASE_CURRENCY} {tuple2dp_to_str(base_bought)} for {fx_selected} {tuple2dp_to_str(fx_spent)}")
     try:
@@ -530,25 +1119,75 @@ def reset_portfolio():
 
 
 def print_history():
-    """Prints history of all transactions"""
-    # get all transactions
-    cursor.execute("SELECT date, currency, delta_fx, delta_base FROM history")
-    history = cursor.fetchall()
-
-    # print all transactions (special for first transaction = starting base amount)
+    """Prints history of all transactions, including those moved to archive segments"""
+    # print all transactions (special for first transaction = starting base amount, which has no fx currency)
     print("=== History ===")
-    for i, row in enumerate(history, 1):
-        if i == 1:
-            print(f"{row[0]}\tStarting: \t{BASE_CURRENCY} {row[3]}")
+    for row in iter_history():
+        if row[2] is None:
+            print(f"{row[1]}\tStarting: \t{BASE_CURRENCY} {row[4]}")
             continue
-        print(f"{row[0]}\t{row[1]} {row[2]}\t{BASE_CURRENCY} {row[3]}")
+        print(f"{row[1]}\t{row[2]} {row[3]}\t{BASE_CURRENCY} {row[4]}")
     print()
 
 
+def checkpoint_history():
+    """Process of archiving history before a cutoff date and verifying the resulting snapshot"""
+    print("=== Checkpoint ===")
+    print("History before the cutoff date will be archived")
+
+    # user to input valid cutoff date
+    try:
+        cutoff = date.fromisoformat(input("\tCutoff date (YYYY-MM-DD): ").strip())
+    except ValueError:
+        print("\tInvalid date\n")
+        return
+
+    try:
+        print(f"\tArchived {checkpoint(str(cutoff))} transactions")
+    except (ValueError, sqlite3.Error) as e:
+        print(f"\tCheckpoint cancelled: {e}\n")
+        return
+    # the checkpoint is already saved, so failing to compact (E.g. database in use by another process) is only reported
+    try:
+        compact_database()
+    except sqlite3.Error as e:
+        print(f"\tDatabase not compacted: {e}")
+    if verify_checkpoint():
+        print("\tVerified: snapshot and history match portfolio\n")
+    else:
+        print("\tVerification failed: snapshot and history do not match portfolio\n")
+
+
+def export_data():
+    """Process of exporting history not yet exported to a new file"""
+    print("=== Export ===")
+    print("History not yet exported will be written to a new file")
+
+    # user to input valid export format
+    export_format = input("\tFormat (csv/parquet): ").strip().lower()
+    if export_format not in ["csv", "parquet"]:
+        print("\tInvalid format\n")
+        return
+
+    try:
+        path, rows = export_history(export_format)
+    except ImportError:
+        print("\tParquet export requires pyarrow\n")
+        return
+    if path is None:
+        print("\tNo new transactions to export\n")
+    else:
+        print(f"\tExported {rows} transactions to {path}\n")
+
+
 if __name__ == "__main__":
+    # "python fx.py publish" runs the rate publisher instead of the app
+    if sys.argv[1:] == ["publish"]:
+        publish_rates()
+
     # initialise database and its cursor
     try:
-        db = sqlite3.connect('db')
+        db = sqlite3.connect(DB_PATH)
         cursor = db.cursor()
     except Exception:
         sys.exit("Could not open/create database")
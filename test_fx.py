@@ -1,5 +1,87 @@
-import pytest
-from fx import fx_received, base_received, str_to_tuple2dp, tuple2dp_greaterthan, tuple2dp_add
+import pytest, sqlite3, csv, mmap, time, json, threading, os, subprocess, sys
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import fx
+from fx import fx_received, base_received, str_to_tuple2dp, tuple2dp_greaterthan, tuple2dp_add, tuple2dp_to_str, \
+    str_to_subqty, subqty_to_tuple2dp
+
+
+@pytest.fixture
+def rate_snapshot(tmp_path, monkeypatch):
+    # memory map of a rate snapshot file, as the publisher process would have it
+    path = tmp_path / "rates.snapshot"
+    monkeypatch.setattr(fx, "BASE_CURRENCY", "USD", raising=False)
+    monkeypatch.setattr(fx, "FX_CURRENCIES", ["EUR", "JPY"], raising=False)
+    monkeypatch.setattr(fx, "RATE_SNAPSHOT_PATH", str(path), raising=False)
+    monkeypatch.setattr(fx, "RATE_MAX_AGE_SECONDS", 30, raising=False)
+    monkeypatch.setattr(fx, "rate_map", None)
+    monkeypatch.setattr(fx, "last_rates", None)
+    monkeypatch.setattr(fx, "DB_PATH", str(tmp_path / "db"), raising=False)
+    monkeypatch.setattr(fx, "API_QUOTA_CALLS", 5000, raising=False)
+    monkeypatch.setattr(fx, "API_QUOTA_SECONDS", 30 * 24 * 60 * 60, raising=False)
+    monkeypatch.setattr(fx, "API_QUOTA_BURST", 20, raising=False)
+    monkeypatch.setattr(fx, "API_QUOTA_PUBLISH_SHARE", 0.5, raising=False)
+    monkeypatch.setattr(fx, "API_QUOTA_RESERVE", 10, raising=False)
+    monkeypatch.setattr(fx, "RATE_SHOW_AGE_SECONDS", 5, raising=False)
+    size = fx.RATE_HEADER.size + fx.RATE_RECORD.size * 2
+    with open(path, "a+b") as file:
+        file.truncate(size)
+        snapshot = mmap.mmap(file.fileno(), size)
+    yield snapshot
+    if fx.rate_map is not None:
+        fx.rate_map.close()
+    snapshot.close()
+
+
+@pytest.fixture
+def rate_api(rate_snapshot, monkeypatch):
+    # local stand-in for the CurrencyBeacon API which counts calls and answers slowly, so concurrent callers overlap
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            with lock:
+                server.calls += 1
+            time.sleep(server.latency + server.delay)
+            body = json.dumps(server.body if server.body is not None else
+                              {"meta": {"code": server.code}, "response": {"rates": {"EUR": server.eur, "JPY": 150}}})
+            self.send_response(200)
+            self.end_headers()
+            self.wfile.write(body.encode())
+
+        def log_message(self, *args):
+            pass
+
+    lock = threading.Lock()
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.calls = 0
+    server.code = 200
+    server.eur = 0.9375
+    server.latency = 0.2
+    server.delay = 0
+    server.body = None
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setattr(fx, "API_KEY", "", raising=False)
+    monkeypatch.setattr(fx, "API_TIMEOUT_SECONDS", 10, raising=False)
+    monkeypatch.setattr(fx, "API_URL", f"http://127.0.0.1:{server.server_port}/v1/latest", raising=False)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def trader_db(tmp_path, monkeypatch):
+    # module globals are normally set up under __main__, so set them up here against a temporary database
+    db = sqlite3.connect(tmp_path / "db")
+    monkeypatch.setattr(fx, "db", db, raising=False)
+    monkeypatch.setattr(fx, "cursor", db.cursor(), raising=False)
+    monkeypatch.setattr(fx, "BASE_CURRENCY", "USD", raising=False)
+    monkeypatch.setattr(fx, "FX_CURRENCIES", ["EUR", "JPY"], raising=False)
+    monkeypatch.setattr(fx, "BASE_START_QTY", 10000, raising=False)
+    monkeypatch.setattr(fx, "BASE_START_SUBQTY", 0, raising=False)
+    monkeypatch.setattr(fx, "ARCHIVE_DIR", str(tmp_path / "archive"), raising=False)
+    monkeypatch.setattr(fx, "EXPORT_DIR", str(tmp_path / "export"), raising=False)
+    monkeypatch.setattr(fx, "EXPORT_CHUNK_ROWS", 10000, raising=False)
+    fx.create_tables()
+    yield db
+    db.close()
 
 
 def test_fx_received():
@@ -178,3 +260,444 @@ def test_tuple2dp_add():
         tuple2dp_add((1, -1), (1, -1))
         tuple2dp_add((-1, 1), (1, -1))
         tuple2dp_add((1, -1), (-1, 1))
+
+
+def test_tuple2dp_to_str():
+    assert tuple2dp_to_str((12, 5)) == "12.05"
+    assert tuple2dp_to_str((-12, -5)) == "-12.05"
+    assert tuple2dp_to_str((0, -5)) == "-0.05"
+    assert tuple2dp_to_str((12, 3456), decimal_places=4) == "12.3456"
+    with pytest.raises(ValueError):
+        tuple2dp_to_str((1, -1))
+
+
+def test_str_to_subqty():
+    assert str_to_subqty(None) == 0
+    assert str_to_subqty("12.05") == 1205
+    assert str_to_subqty("-12.05") == -1205
+    assert str_to_subqty("-0.05") == -5
+    assert subqty_to_tuple2dp(1205) == (12, 5)
+    assert subqty_to_tuple2dp(-1205) == (-12, -5)
+    assert subqty_to_tuple2dp(-5) == (0, -5)
+    assert subqty_to_tuple2dp(0) == (0, 0)
+
+
+def test_checkpoint(trader_db, tmp_path):
+    fx.update_portfolio("EUR", (90, 12), (-100, 0))
+    fx.update_portfolio("EUR", (0, -5), (0, 5))
+    fx.update_portfolio("JPY", (1500, 0), (-10, -50))
+    history = list(fx.iter_history())
+
+    # nothing is dated before the cutoff
+    assert fx.checkpoint("2000-01-01") == 0
+    # everything is dated before the cutoff
+    assert fx.checkpoint("9999-12-31") == 4
+    assert trader_db.execute("SELECT COUNT(*) FROM history").fetchone()[0] == 0
+    assert fx.verify_checkpoint()
+    assert fx.get_snapshot() == (4, {"USD": 988955, "EUR": 9007, "JPY": 150000})
+
+    # later trades stack on top of the snapshot, and history spans segment and live rows
+    fx.update_portfolio("JPY", (-500, 0), (3, 40))
+    assert fx.verify_checkpoint()
+    assert list(fx.iter_history())[:4] == history
+    assert [row[0] for row in fx.iter_history(after_id=4)] == [5]
+
+    # a second checkpoint appends a new segment and merges into the existing monthly rollups
+    assert fx.checkpoint("9999-12-31") == 1
+    assert fx.verify_checkpoint()
+    assert len(list(fx.iter_history())) == 5
+    assert trader_db.execute("SELECT COUNT(*) FROM archive").fetchone()[0] == 2
+    assert trader_db.execute(
+        "SELECT trades, fx_qty, fx_subqty, base_qty, base_subqty FROM rollup WHERE currency = 'JPY'"
+    ).fetchone() == (2, 1000, 0, -7, -10)
+
+    # tampering with the portfolio is caught, and no checkpoint is made from the mismatched history
+    trader_db.execute("UPDATE portfolio SET subqty = subqty + 1 WHERE currency = 'EUR'")
+    assert not fx.verify_checkpoint()
+    fx.update_portfolio("EUR", (1, 0), (-1, -10))
+    with pytest.raises(ValueError):
+        fx.checkpoint("9999-12-31")
+    assert trader_db.execute("SELECT COUNT(*) FROM history").fetchone()[0] == 1
+    assert trader_db.execute("SELECT COUNT(*) FROM archive").fetchone()[0] == 2
+    assert len(list((tmp_path / "archive").iterdir())) == 2
+
+
+def test_checkpoint_write_failure(trader_db, tmp_path, monkeypatch, capsys):
+    fx.update_portfolio("EUR", (90, 12), (-100, 0))
+    # a write part way through the checkpoint fails
+    trader_db.execute("CREATE TRIGGER fail BEFORE INSERT ON snapshot BEGIN SELECT RAISE(ABORT, 'disk full'); END")
+    trader_db.commit()
+    with pytest.raises(sqlite3.Error, match="disk full"):
+        fx.checkpoint("9999-12-31")
+    assert not trader_db.in_transaction
+    assert os.listdir(tmp_path / "archive") == []
+    assert trader_db.execute("SELECT COUNT(*) FROM history").fetchone()[0] == 2
+    assert trader_db.execute("SELECT COUNT(*) FROM archive").fetchone()[0] == 0
+
+    # the menu reports it rather than exiting
+    monkeypatch.setattr("builtins.input", lambda prompt: "9999-12-31")
+    fx.checkpoint_history()
+    assert "Checkpoint cancelled: disk full" in capsys.readouterr().out
+
+    trader_db.execute("DROP TRIGGER fail")
+    fx.checkpoint_history()
+    assert "Archived 2 transactions" in capsys.readouterr().out
+    assert os.listdir(tmp_path / "archive") == ["history_1_2.csv.gz"]
+
+
+def test_migrate_history_signs(trader_db):
+    fx.update_portfolio("EUR", (0, -50), (1, 5))
+    fx.update_portfolio("EUR", (10, 0), (0, -80))
+    fx.update_portfolio("EUR", (0, 0), (0, -1))
+    fx.update_portfolio("EUR", (0, 20), (0, -30))
+    # rows as written by versions which dropped the sign of negative amounts under 1
+    trader_db.execute("UPDATE history SET delta_fx = '0.50' WHERE id = 2")
+    trader_db.execute("UPDATE history SET delta_base = '0.80' WHERE id = 3")
+    trader_db.execute("UPDATE history SET delta_base = '0.01' WHERE id = 4")
+    trader_db.execute("UPDATE history SET delta_base = '0.30' WHERE id = 5")
+    assert not fx.verify_checkpoint()
+
+    assert fx.migrate_history_signs() == 3
+    assert trader_db.execute("SELECT delta_fx, delta_base FROM history WHERE id > 1").fetchall() == \
+           [("-0.50", "1.05"), ("10.00", "-0.80"), ("0.00", "-0.01"), ("0.20", "0.30")]
+    # both deltas under 1 is ambiguous, so the row is left and checkpoints refuse to archive it
+    with pytest.raises(ValueError):
+        fx.checkpoint("9999-12-31")
+    trader_db.execute("UPDATE history SET delta_base = '-0.30' WHERE id = 5")
+    assert fx.migrate_history_signs() == 0
+    assert fx.checkpoint("9999-12-31") == 5
+
+
+def test_export_history_csv(trader_db):
+    fx.update_portfolio("EUR", (90, 12), (-100, 0))
+    fx.update_portfolio("EUR", (0, -5), (0, 5))
+    # archived rows are exported too
+    fx.checkpoint("9999-12-31")
+    fx.update_portfolio("JPY", (1500, 0), (-10, -50))
+
+    path, rows = fx.export_history("csv", chunk_rows=2)
+    assert rows == 4
+    with open(path, newline="") as file:
+        exported = list(csv.reader(file))
+    assert exported[0] == ["id", "date", "currency", "delta_fx_subqty", "delta_base_subqty"]
+    assert [row[0] for row in exported[1:]] == ["1", "2", "3", "4"]
+    assert [row[2:] for row in exported[1:]] == [["", "", "1000000"], ["EUR", "9012", "-10000"],
+                                                 ["EUR", "-5", "5"], ["JPY", "150000", "-1050"]]
+
+    # incremental: only new rows are exported
+    assert fx.export_history("csv") == (None, 0)
+    fx.update_portfolio("JPY", (-500, 0), (3, 40))
+    path, rows = fx.export_history("csv")
+    assert rows == 1
+    assert os.path.basename(path).startswith("history_5_5_")
+
+    # ids restart after a reset, but earlier exports are never overwritten
+    fx.reset_portfolio()
+    fx.update_portfolio("EUR", (1, 0), (-1, -10))
+    assert fx.export_history("csv")[1] == 2
+    assert len(os.listdir(fx.EXPORT_DIR)) == 3
+
+    with pytest.raises(ValueError):
+        fx.export_history("xlsx")
+
+
+def test_export_history_concurrent_checkpoint(trader_db, tmp_path, monkeypatch):
+    trader_db.execute("PRAGMA journal_mode=WAL")
+    fx.update_portfolio("EUR", (90, 12), (-100, 0))
+    fx.checkpoint("9999-12-31")
+    fx.update_portfolio("EUR", (0, -5), (0, 5))
+    fx.update_portfolio("JPY", (1500, 0), (-10, -50))
+
+    # another process checkpoints the live rows while the export is still reading the archive
+    history = fx.iter_history()
+    rows = [next(history)]
+    other = sqlite3.connect(tmp_path / "db")
+    with monkeypatch.context() as m:
+        m.setattr(fx, "db", other)
+        m.setattr(fx, "cursor", other.cursor())
+        assert fx.checkpoint("9999-12-31") == 2
+    other.close()
+    rows += list(history)
+    assert [row[0] for row in rows] == [1, 2, 3, 4]
+    assert not trader_db.in_transaction
+
+
+def test_export_history_parquet(trader_db):
+    pq = pytest.importorskip("pyarrow.parquet")
+    for _ in range(5):
+        fx.update_portfolio("EUR", (1, 0), (-1, -10))
+
+    path, rows = fx.export_history("parquet", chunk_rows=2)
+    assert rows == 6
+    file = pq.ParquetFile(path)
+    # one row group per chunk
+    assert file.num_row_groups == 3
+    table = file.read()
+    assert table.column("id").to_pylist() == [1, 2, 3, 4, 5, 6]
+    assert table.column("delta_fx_subqty").to_pylist() == [None] + [100] * 5
+    assert table.column("delta_base_subqty").to_pylist() == [1000000] + [-110] * 5
+
+    # formats are tracked separately
+    assert fx.export_history("parquet") == (None, 0)
+    assert fx.export_history("csv")[1] == 6
+
+
+def test_rate_snapshot(rate_snapshot, monkeypatch):
+    # nothing published yet
+    assert fx.read_rate_snapshot() is None
+
+    fx.write_rate_snapshot(rate_snapshot, {"EUR": 0.91234567, "JPY": 150})
+    published, rates = fx.read_rate_snapshot()
+    assert time.time() - published < 5
+    assert rates == {"EUR": ((0, 9123), (0, 9124)), "JPY": ((150, 0), (150, 0))}
+
+    # fresh snapshot is used without calling the API
+    def fetch_rates():
+        raise AssertionError("API called")
+    monkeypatch.setattr(fx, "fetch_rates", fetch_rates)
+    assert fx.get_rates("buy") == {"EUR": (0, 9123), "JPY": (150, 0)}
+    assert fx.get_rates("sell") == {"EUR": (0, 9124), "JPY": (150, 0)}
+
+    # updates by the publisher are seen through the existing mapping
+    fx.write_rate_snapshot(rate_snapshot, {"EUR": 0.9375, "JPY": 149.5})
+    assert fx.get_rates("buy") == {"EUR": (0, 9375), "JPY": (149, 5000)}
+
+    # a snapshot mid-write is never returned
+    seq = fx.RATE_HEADER.unpack_from(rate_snapshot, 0)[0]
+    fx.RATE_HEADER.pack_into(rate_snapshot, 0, seq + 1, time.time(), 2)
+    assert fx.read_rate_snapshot() is None
+
+    # a publisher stopped mid-write leaves seq odd, and the next one still publishes complete snapshots only
+    fx.write_rate_snapshot(rate_snapshot, {"EUR": 0.875, "JPY": 149.5})
+    assert fx.RATE_HEADER.unpack_from(rate_snapshot, 0)[0] % 2 == 0
+    assert fx.get_rates("buy") == {"EUR": (0, 8750), "JPY": (149, 5000)}
+
+    # a publisher with other currencies is ignored
+    monkeypatch.setattr(fx, "FX_CURRENCIES", ["EUR", "GBP"])
+    fx.write_rate_snapshot(rate_snapshot, {"EUR": 0.875, "GBP": 0.75})
+    monkeypatch.setattr(fx, "FX_CURRENCIES", ["EUR", "JPY"])
+    assert fx.read_rate_snapshot() is None
+
+
+def test_rate_snapshot_stale(rate_snapshot, monkeypatch):
+    fx.write_rate_snapshot(rate_snapshot, {"EUR": 0.9, "JPY": 150})
+    monkeypatch.setattr(fx, "RATE_MAX_AGE_SECONDS", -1)
+    # stale snapshot falls back to the API
+    monkeypatch.setattr(fx, "fetch_rates", lambda: {"EUR": 0.8, "JPY": 140})
+    assert fx.get_rates("buy") == {"EUR": (0, 8000), "JPY": (140, 0)}
+
+
+def test_get_rates_coalesced(rate_api):
+    results = []
+
+    def worker():
+        results.append(fx.get_rates("buy"))
+
+    threads = [threading.Thread(target=worker) for _ in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # all concurrent callers share one upstream call
+    assert rate_api.calls == 1
+    assert results == [{"EUR": (0, 9375), "JPY": (150, 0)}] * 20
+
+    # later callers make a new call
+    fx.get_rates("sell")
+    assert rate_api.calls == 2
+
+
+def test_get_rates_quota(rate_api, monkeypatch, capsys):
+    monkeypatch.setattr(fx, "API_QUOTA_BURST", 2)
+    assert fx.get_rates("buy") == {"EUR": (0, 9375), "JPY": (150, 0)}
+    assert fx.get_rates("buy") == {"EUR": (0, 9375), "JPY": (150, 0)}
+    assert rate_api.calls == 2
+
+    # budget used up: last good rates are used and their age shown, without calling upstream
+    capsys.readouterr()
+    assert fx.get_rates("sell") == {"EUR": (0, 9375), "JPY": (150, 0)}
+    assert rate_api.calls == 2
+    assert "API quota budget used up: using rates from 0 seconds ago" in capsys.readouterr().out
+
+    # budget refills over time
+    with sqlite3.connect(fx.DB_PATH) as quota_db:
+        quota_db.execute("UPDATE quota SET time = time - 30 * 24 * 60 * 60")
+    fx.get_rates("buy")
+    assert rate_api.calls == 3
+
+
+def test_take_quota_token_shared(rate_snapshot, monkeypatch):
+    monkeypatch.setattr(fx, "API_QUOTA_BURST", 10)
+    taken = []
+
+    def worker():
+        taken.append(fx.take_quota_token())
+
+    # every thread (and process, through the database file) draws from one budget
+    threads = [threading.Thread(target=worker) for _ in range(15)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert taken.count(True) == 10
+
+    # another process, or this one after a restart, finds the budget used up
+    code = "import fx; fx.DB_PATH = {!r}; fx.API_QUOTA_CALLS = 5000; fx.API_QUOTA_SECONDS = 2592000; " \
+           "fx.API_QUOTA_BURST = 10; print(fx.take_quota_token())".format(fx.DB_PATH)
+    result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True,
+                            cwd=os.path.dirname(fx.__file__))
+    assert result.stdout.strip() == "False"
+
+
+def test_get_rates_api_error(rate_api, capsys):
+    # no last good rates to fall back on
+    rate_api.code = 429
+    with pytest.raises(fx.RatesUnavailableError, match="API error code 429"):
+        fx.get_rates("buy")
+
+    rate_api.code = 200
+    fx.get_rates("buy")
+    rate_api.code = 429
+    assert fx.get_rates("buy") == {"EUR": (0, 9375), "JPY": (150, 0)}
+    assert "API error code 429: using rates from" in capsys.readouterr().out
+
+
+def test_get_rates_bad_payload(rate_api, capsys):
+    fx.get_rates("buy")
+    # a bad rate is reported to every waiting caller as unavailable, instead of exiting
+    rate_api.eur = "abc"
+    assert fx.get_rates("buy") == {"EUR": (0, 9375), "JPY": (150, 0)}
+    assert "API returned non-numeric rate" in capsys.readouterr().out
+    rate_api.eur = -1
+    assert fx.get_rates("buy") == {"EUR": (0, 9375), "JPY": (150, 0)}
+    assert "API returned non-positive rate" in capsys.readouterr().out
+
+
+def test_get_rates_incomplete_payload(rate_api, rate_snapshot, capsys):
+    # no rates to fall back on yet
+    rate_api.body = {"meta": {"code": 200}, "response": {"rates": {"EUR": 0.9375}}}
+    with pytest.raises(fx.RatesUnavailableError, match="API returned no rate for JPY"):
+        fx.get_rates("buy")
+    rate_api.body = {"meta": {"code": 200}, "response": []}
+    with pytest.raises(fx.RatesUnavailableError, match="malformed"):
+        fx.get_rates("buy")
+    rate_api.body = []
+    with pytest.raises(fx.RatesUnavailableError, match="malformed"):
+        fx.get_rates("buy")
+
+    # incomplete rates are never kept as the last good rates
+    rate_api.body = None
+    fx.get_rates("buy")
+    rate_api.body = {"meta": {"code": 200}, "response": {"rates": {"EUR": 0.5}}}
+    assert fx.get_rates("buy") == {"EUR": (0, 9375), "JPY": (150, 0)}
+
+    # publisher: a missing rate leaves the previous snapshot readable
+    fx.write_rate_snapshot(rate_snapshot, {"EUR": 0.875, "JPY": 150})
+    with pytest.raises(fx.RatesUnavailableError):
+        fx.write_rate_snapshot(rate_snapshot, {"EUR": 0.5})
+    assert fx.RATE_HEADER.unpack_from(rate_snapshot, 0)[0] == 2
+    assert fx.read_rate_snapshot()[1]["EUR"] == ((0, 8750), (0, 8750))
+
+
+def test_get_rates_timeout(rate_api, monkeypatch, capsys):
+    fx.get_rates("buy")
+    monkeypatch.setattr(fx, "API_TIMEOUT_SECONDS", 0.5)
+    rate_api.delay = 2
+    start = time.time()
+    assert fx.get_rates("buy") == {"EUR": (0, 9375), "JPY": (150, 0)}
+    assert time.time() - start < 1.5
+    assert "API timeout" in capsys.readouterr().out
+
+
+def test_get_rates_max_age(rate_api, rate_snapshot, monkeypatch):
+    # published rates older than a quote may use are not used for trades
+    fx.write_rate_snapshot(rate_snapshot, {"EUR": 0.875, "JPY": 150})
+    seq = fx.RATE_HEADER.unpack_from(rate_snapshot, 0)[0]
+    fx.RATE_HEADER.pack_into(rate_snapshot, 0, seq, time.time() - 100, 2)
+    monkeypatch.setattr(fx, "RATE_MAX_AGE_SECONDS", 1000)
+    assert fx.get_rates("buy") == {"EUR": (0, 8750), "JPY": (150, 0)}
+    assert fx.get_rates("buy", max_age=60) == {"EUR": (0, 9375), "JPY": (150, 0)}
+    assert rate_api.calls == 1
+
+    # stale fallback is fine for display, but not for trades
+    rate_api.code = 429
+    monkeypatch.setattr(fx, "RATE_MAX_AGE_SECONDS", 10)
+    monkeypatch.setattr(fx, "last_rates", (time.time() - 200, fx.last_rates[1]))
+    assert fx.get_rates("sell") == {"EUR": (0, 8750), "JPY": (150, 0)}
+    with pytest.raises(fx.RatesUnavailableError):
+        fx.get_rates("sell", max_age=60)
+
+
+def test_main_database_locked(trader_db, tmp_path, monkeypatch):
+    fx.update_portfolio("EUR", (90, 12), (-100, 0))
+    # database from before exports existed, so startup needs to write
+    trader_db.execute("DROP TABLE export")
+    trader_db.commit()
+    # another process holds the write lock while the app starts
+    monkeypatch.setattr(fx, "db", sqlite3.connect(tmp_path / "db", timeout=0.1))
+    monkeypatch.setattr(fx, "cursor", fx.db.cursor())
+    monkeypatch.setattr("builtins.input", lambda prompt: "9")
+    other = sqlite3.connect(tmp_path / "db", isolation_level=None)
+    other.execute("BEGIN IMMEDIATE")
+    with pytest.raises(sqlite3.OperationalError, match="locked"):
+        fx.main()
+    other.execute("ROLLBACK")
+    other.close()
+    # the portfolio is left as it was rather than reset
+    assert trader_db.execute("SELECT COUNT(*) FROM history").fetchone()[0] == 2
+
+    fx.main()
+    assert trader_db.execute("SELECT COUNT(*) FROM history").fetchone()[0] == 2
+    assert trader_db.execute("SELECT COUNT(*) FROM export").fetchone()[0] == 0
+
+
+def test_main_new_database(tmp_path, monkeypatch, trader_db):
+    trader_db.execute("DROP TABLE history")
+    monkeypatch.setattr("builtins.input", lambda prompt: "9")
+    fx.main()
+    db = sqlite3.connect(tmp_path / "db")
+    assert db.execute("SELECT COUNT(*) FROM history").fetchone()[0] == 1
+    db.close()
+
+
+def test_publisher_and_trade_quotes_share_budget(rate_api, rate_snapshot, monkeypatch, capsys):
+    # the default settings scaled down: 20 calls a second, publishing at half that, quotes needing fresher rates
+    # than the publisher gives, and more quotes than the burst so they rely on the part of the refill left to them
+    monkeypatch.setattr(fx, "API_QUOTA_CALLS", 100)
+    monkeypatch.setattr(fx, "API_QUOTA_SECONDS", 5)
+    monkeypatch.setattr(fx, "API_QUOTA_BURST", 4)
+    monkeypatch.setattr(fx, "API_QUOTA_RESERVE", 2)
+    monkeypatch.setattr(fx, "RATE_PUBLISH_SECONDS", 5 / (100 * 0.5), raising=False)
+    monkeypatch.setattr(fx, "RATE_MAX_AGE_SECONDS", 2 * fx.RATE_PUBLISH_SECONDS)
+    monkeypatch.setattr(fx, "QUOTE_MAX_AGE_SECONDS", 0.01, raising=False)
+    monkeypatch.setattr(fx, "RATE_SHOW_AGE_SECONDS", 0.005)
+    rate_api.latency = 0
+    start = time.time()
+    stop = threading.Event()
+    published = []
+
+    def publisher():
+        while not stop.is_set():
+            published.append(fx.publish_rates_once(rate_snapshot))
+            stop.wait(fx.RATE_PUBLISH_SECONDS)
+
+    thread = threading.Thread(target=publisher)
+    thread.start()
+    refused = 0
+    for _ in range(20):
+        # display uses published rates with their age shown, trade quotes fetch fresh rates
+        fx.get_rates("sell")
+        try:
+            fx.get_rates("buy", max_age=fx.QUOTE_MAX_AGE_SECONDS)
+        except fx.RatesUnavailableError:
+            refused += 1
+        time.sleep(0.15)
+    stop.set()
+    thread.join()
+    elapsed = time.time() - start
+
+    assert refused == 0
+    assert published.count(True) >= 20
+    assert "Using rates from 0 seconds ago" in capsys.readouterr().out
+    # never more upstream calls than the budget allows
+    assert rate_api.calls <= 4 + elapsed * 20